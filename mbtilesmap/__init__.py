@@ -13,4 +13,16 @@ app_settings = EasyDict(dict(
     MBTILES_ROOT = os.getenv('MBTILES_ROOT', os.path.join(settings.MEDIA_ROOT, 'data')),
     TILE_SIZE = 256,
     MISSING_TILE_404 = False,
+    INGEST_BATCH_SIZE = 1000,
+    # Seconds to wait for other writers
+    INGEST_TIMEOUT = 5,
+    INGEST_VIEW_ENABLED = False,
+    WATCHER_INTERVAL = 2,
+    VECTOR_TILES_CACHE_TIMEOUT = 60 * 60 * 24,
+    # Limits are (requests per second, burst)
+    RATE_LIMIT_CLIENT = None,
+    RATE_LIMIT_API_KEYS = (),
+    RATE_LIMIT_TILESET = None,
+    RATE_LIMIT_TILESETS = {},
+    RATE_LIMIT_BACKEND = 'memory',
 ), **getattr(settings, 'MBTILES_APP_CONFIG', {}))
@@ -0,0 +1,157 @@
+import os
+import json
+import sqlite3
+import hashlib
+from itertools import islice
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mbtilesmap.utils import flip_y, MAX_LATITUDE
+from mbtilesmap.vectortiles import gzip
+
+
+FORMATS = ('png', 'jpg', 'pbf')
+
+MAGIC = {
+    'png': '\x89PNG\r\n\x1a\n',
+    'jpg': '\xff\xd8\xff\xe0',
+}
+
+VECTOR_LAYERS = ('roads', 'water', 'buildings')
+
+
+def tile_index(z, x, y, distinct):
+    """ Index of the (deterministic) contents of the XYZ tile """
+    return int(hashlib.md5('%s/%s/%s' % (z, x, y)).hexdigest(), 16) % distinct
+
+
+def synthetic_tile(index, format='png', size=1024):
+    """
+    Return the synthetic contents number ``index``. Images are not decodable,
+    only their header is valid. Vector tiles are valid and gzipped.
+    """
+    if format == 'pbf':
+        data = ''
+        for name in VECTOR_LAYERS:
+            # Layer version (15), name (1) and a key (3) padded to the expected size
+            key = (str(index) + '-' * size)[:max(1, size / len(VECTOR_LAYERS))]
+            layer = '\x78\x02' + '\x0a' + chr(len(name)) + name + '\x1a' + _varint(len(key)) + key
+            data += '\x1a' + _varint(len(layer)) + layer
+        return gzip(data)
+    header = MAGIC[format] + str(index)
+    filler = hashlib.sha1(header).digest()
+    return header + (filler * (size / len(filler) + 1))[:max(0, size - len(header))]
+
+
+def _varint(value):
+    result = ''
+    while value > 0x7f:
+        result += chr((value & 0x7f) | 0x80)
+        value >>= 7
+    return result + chr(value)
+
+
+def world_tiles(minzoom, count):
+    """ Yield ``count`` XYZ tiles, zoom level after zoom level from ``minzoom`` """
+    z = minzoom
+    while True:
+        n = 2 ** z
+        for x in xrange(n):
+            for y in xrange(n):
+                if count <= 0:
+                    return
+                count -= 1
+                yield (z, x, y)
+        z += 1
+
+
+def generate(path, count, dedup=0.0, format='png', size=1024, minzoom=0, batch_size=10000):
+    """
+    Create a MBTiles file of ``count`` synthetic tiles, of which a ``dedup``
+    ratio share their contents (stored in ``map`` and ``images`` tables if > 0).
+    Returns the maximum zoom level.
+    """
+    distinct = max(1, int(round(count * (1.0 - dedup))))
+    con = sqlite3.connect(path)
+    con.execute('PRAGMA synchronous=OFF')
+    con.execute('PRAGMA journal_mode=OFF')
+    con.execute('CREATE TABLE metadata (name text, value text);')
+    con.execute('CREATE UNIQUE INDEX name ON metadata (name);')
+    if dedup > 0:
+        con.execute('CREATE TABLE images (tile_data blob, tile_id text);')
+        con.execute('CREATE TABLE map (zoom_level integer, tile_column integer, tile_row integer, '
+                    'tile_id text, grid_id text);')
+        con.execute('CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, '
+                    'map.tile_column AS tile_column, map.tile_row AS tile_row, '
+                    'images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id;')
+        images = ((sqlite3.Binary(synthetic_tile(i, format, size)), str(i)) for i in xrange(distinct))
+        while True:
+            batch = list(islice(images, batch_size))
+            if not batch:
+                break
+            con.executemany('INSERT INTO images (tile_data, tile_id) VALUES (?, ?);', batch)
+        con.execute('CREATE UNIQUE INDEX images_id ON images (tile_id);')
+        rows = ((z, x, flip_y(y, z), str(tile_index(z, x, y, distinct)))
+                for (z, x, y) in world_tiles(minzoom, count))
+        sql = 'INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);'
+        index = 'CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);'
+    else:
+        con.execute('CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, '
+                    'tile_data blob);')
+        rows = ((z, x, flip_y(y, z), sqlite3.Binary(synthetic_tile(tile_index(z, x, y, distinct), format, size)))
+                for (z, x, y) in world_tiles(minzoom, count))
+        sql = 'INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);'
+        index = 'CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);'
+    maxzoom = minzoom
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        con.executemany(sql, batch)
+        maxzoom = batch[-1][0]
+    con.execute(index)
+    metadata = {
+        'name': os.path.splitext(os.path.basename(path))[0],
+        'format': format,
+        'minzoom': minzoom,
+        'maxzoom': maxzoom,
+        'bounds': '-180,%s,180,%s' % (-MAX_LATITUDE, MAX_LATITUDE),
+    }
+    if format == 'pbf':
+        metadata['json'] = json.dumps({'vector_layers': [{'id': name} for name in VECTOR_LAYERS]})
+    con.executemany('INSERT INTO metadata (name, value) VALUES (?, ?);',
+                    [(name, str(value)) for name, value in metadata.items()])
+    con.commit()
+    con.close()
+    return maxzoom
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = 'Create a MBTiles file of synthetic tiles, for load testing'
+    option_list = BaseCommand.option_list + (
+        make_option('--tiles', dest='count', type='int', default=1000000,
+                    help='Number of tiles'),
+        make_option('--dedup', dest='dedup', type='float', default=0.0,
+                    help='Ratio of tiles sharing their contents (0 to 1)'),
+        make_option('--format', dest='format', type='choice', choices=FORMATS, default='png',
+                    help='Tiles format (%s)' % ', '.join(FORMATS)),
+        make_option('--size', dest='size', type='int', default=1024,
+                    help='Approximate size of tiles in bytes'),
+        make_option('--minzoom', dest='minzoom', type='int', default=0,
+                    help='First zoom level to fill'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: mbtiles_generate %s' % self.args)
+        path = args[0]
+        if os.path.exists(path):
+            raise CommandError("'%s' already exists" % path)
+        if not 0 <= options['dedup'] < 1:
+            raise CommandError('Deduplication ratio must be between 0 and 1')
+        maxzoom = generate(path, options['count'], options['dedup'], options['format'],
+                           options['size'], options['minzoom'])
+        self.stdout.write('%s tiles written into %s (zoom levels %s to %s)\n' % (
+                          options['count'], path, options['minzoom'], maxzoom))
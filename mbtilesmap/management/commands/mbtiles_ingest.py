@@ -0,0 +1,67 @@
+import os
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mbtilesmap.models import MBTiles, MBTilesNotFoundError
+from mbtilesmap.utils import flip_y, check_tile
+
+
+logger = logging.getLogger(__name__)
+
+
+def walk_tiles(folder, tms=False):
+    """
+    Yield (z, x, y, data) from a ``folder/z/x/y.ext`` tree of tiles,
+    skipping files with invalid coordinates.
+    """
+    for dirname, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        relative = os.path.relpath(dirname, folder).split(os.sep)
+        if len(relative) != 2:
+            continue
+        for filename in sorted(filenames):
+            y, ext = os.path.splitext(filename)
+            try:
+                z, x, y = int(relative[0]), int(relative[1]), int(y)
+                if tms:
+                    y = flip_y(y, z)
+                z, x, y = check_tile(z, x, y)
+            except ValueError:
+                logger.warning("Skip %s" % os.path.join(dirname, filename))
+                continue
+            with open(os.path.join(dirname, filename), 'rb') as f:
+                yield (z, x, y, f.read())
+
+
+class Command(BaseCommand):
+    args = '<name> <folder>'
+    help = 'Write the tiles of a z/x/y folder tree into an existing MBTiles file'
+    option_list = BaseCommand.option_list + (
+        make_option('--catalog', dest='catalog', default=None,
+                    help='Catalog (subfolder of MBTILES_ROOT) of the MBTiles file'),
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+                    help='Number of tiles written per transaction'),
+        make_option('--tms', dest='tms', action='store_true', default=False,
+                    help='Tiles rows of the folder tree follow the TMS scheme'),
+        make_option('--prune-changes', dest='prune_changes', type='int', default=None,
+                    help='Remove changes older than this sequence number from the change log'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: mbtiles_ingest %s' % self.args)
+        name, folder = args
+        if not os.path.isdir(folder):
+            raise CommandError("Folder '%s' does not exist" % folder)
+        try:
+            mbtiles = MBTiles(name, options['catalog'])
+        except MBTilesNotFoundError, e:
+            raise CommandError(e)
+        with mbtiles.writer(options['batch_size']) as writer:
+            written = writer.ingest(walk_tiles(folder, options['tms']))
+        self.stdout.write('%s tiles written into %s\n' % (written, mbtiles.fullpath))
+        if options['prune_changes'] is not None:
+            removed = mbtiles.prune_changes(options['prune_changes'])
+            self.stdout.write('%s changes removed from %s\n' % (removed, mbtiles.fullpath))
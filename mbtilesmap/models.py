@@ -1,22 +1,33 @@
 # -*- coding: utf-8 -*-
 import os
+import copy
 import logging
 import json
 import glob
+import time
+import sqlite3
+import hashlib
 
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.utils.translation import ugettext as _
 from landez.sources import MBTilesReader, ExtractionError, InvalidFormatError
-from landez.proj import GoogleProjection
 
 from . import app_settings
-from utils import reify
+from utils import reify, flip_y, check_tile, tile_bounds, tile_at, tile_ranges
 
 
 logger = logging.getLogger(__name__)
 
 
+MIMETYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'webp': 'image/webp',
+    'pbf': 'application/x-protobuf',
+}
+
+
 class MissingTileError(Exception):
     pass
 
@@ -37,7 +48,10 @@ class MBTilesManager(object):
 
     def filter(self, catalog=None):
         if catalog:
-            self.folder = self.catalog_path(catalog)
+            # Return a new manager, since ``MBTiles.objects`` is shared among threads
+            filtered = copy.copy(self)
+            filtered.folder = self.catalog_path(catalog)
+            return filtered
         return self
 
     def all(self):
@@ -113,6 +127,25 @@ class MBTiles(object):
     def name(self):
         return self.metadata.get('name', self.id)
 
+    @property
+    def format(self):
+        return self.metadata.get('format', 'png')
+
+    @property
+    def mimetype(self):
+        return MIMETYPES.get(self.format, 'application/octet-stream')
+
+    @reify
+    def vector_layers(self):
+        """
+        Return the vector layers descriptions, from the ``json`` metadata.
+        """
+        try:
+            return json.loads(self.metadata.get('json', '{}')).get('vector_layers', [])
+        except (ValueError, AttributeError):
+            logger.warning(_("Invalid json metadata in '%s'.") % self.name)
+            return []
+
     @property
     def filesize(self):
         return os.path.getsize(self.fullpath)
@@ -171,10 +204,58 @@ class MBTiles(object):
         except ExtractionError:
             raise MissingTileError
 
+    def writer(self, batch_size=None, timeout=None):
+        return MBTilesWriter(self, batch_size, timeout)
+
+    def changes(self, since=0):
+        """
+        Return the list of (seq, z, x, y) tiles modified after the ``since``
+        sequence number, as recorded by ``MBTilesWriter``.
+        """
+        con = sqlite3.connect(self.fullpath)
+        try:
+            table = con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                (MBTilesWriter.CHANGES_TABLE,)).fetchone()
+            if table is None:
+                # No tile was ever written in this file
+                return []
+            rows = con.execute('''SELECT seq, zoom_level, tile_column, tile_row
+                                  FROM %s WHERE seq > ? ORDER BY seq;''' % MBTilesWriter.CHANGES_TABLE,
+                               (int(since),)).fetchall()
+        finally:
+            con.close()
+        return [(seq, z, x, flip_y(y, z)) for (seq, z, x, y) in rows]
+
+    def prune_changes(self, before_seq):
+        """
+        Remove changes older than the ``before_seq`` sequence number from the
+        change log, return the number of removed changes.
+        """
+        con = sqlite3.connect(self.fullpath, timeout=app_settings.INGEST_TIMEOUT)
+        try:
+            table = con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                (MBTilesWriter.CHANGES_TABLE,)).fetchone()
+            if table is None:
+                return 0
+            removed = con.execute('DELETE FROM %s WHERE seq < ?;' % MBTilesWriter.CHANGES_TABLE,
+                                  (int(before_seq),)).rowcount
+            con.commit()
+        finally:
+            con.close()
+        return removed
+
     def center_tile(self):
         lon, lat, zoom = self.center
-        proj = GoogleProjection(app_settings.TILE_SIZE, [zoom])
-        return proj.tile_at(zoom, (lon, lat))
+        return tile_at(lon, lat, zoom)
+
+    def tile_ranges(self, zoomlevels=None):
+        """
+        Return the ranges of XYZ tiles covering the bounds, for each of
+        the ``zoomlevels`` (available ones by default).
+        """
+        if zoomlevels is None:
+            zoomlevels = self.zoomlevels
+        return tile_ranges(self.bounds, zoomlevels)
 
     def grid(self, z, x, y, callback=None):
         try:
@@ -192,16 +273,20 @@ class MBTiles(object):
             "minzoom": self.minzoom,
             "maxzoom": self.maxzoom,
         })
+        if self.vector_layers:
+            jsonp.pop('json', None)
+            jsonp["vector_layers"] = self.vector_layers
         # Additionnal info
+        tileurl = "vectortile" if self.format == 'pbf' else "tile"
         try:
             kwargs = dict(name=self.id, x='{x}',y='{y}',z='{z}')
             if self.catalog:
                 kwargs['catalog'] = self.catalog
-            tilepattern = reverse("mbtilesmap:tile", kwargs=kwargs)
+            tilepattern = reverse("mbtilesmap:%s" % tileurl, kwargs=kwargs)
             gridpattern = reverse("mbtilesmap:grid", kwargs=kwargs)
         except NoReverseMatch:
             # In case django-mbtiles was not registered in namespace mbtilesmap
-            tilepattern = reverse("tile", kwargs=dict(name=self.id, x='{x}',y='{y}',z='{z}'))
+            tilepattern = reverse(tileurl, kwargs=dict(name=self.id, x='{x}',y='{y}',z='{z}'))
             gridpattern = reverse("grid", kwargs=dict(name=self.id, x='{x}',y='{y}',z='{z}'))
         tilepattern = request.build_absolute_uri(tilepattern)
         gridpattern = request.build_absolute_uri(gridpattern)
@@ -218,3 +303,165 @@ class MBTiles(object):
             "grids": [gridpattern]
         })
         return json.dumps(jsonp)
+
+
+class MBTilesWriter(object):
+    """
+    Write tiles into an existing MBTiles file.
+
+    Tiles are inserted in batched transactions, the file is switched to WAL
+    journal mode so that readers keep serving while writing, and every
+    written tile is recorded in a change log (see ``MBTiles.changes()``).
+    Zoom levels and bounds metadata are extended with committed tiles on
+    ``close()`` and ``rollback()``.
+    """
+    CHANGES_TABLE = 'tiles_changes'
+
+    def __init__(self, mbtiles, batch_size=None, timeout=None):
+        self.mbtiles = mbtiles
+        self.batch_size = int(batch_size or app_settings.INGEST_BATCH_SIZE)
+        self.written = 0
+        self._pending = 0
+        # Extent of committed tiles, and of the current batch
+        self._zoomlevels = set()
+        self._bounds = None
+        self._batch_zoomlevels = set()
+        self._batch_bounds = None
+        if timeout is None:
+            timeout = app_settings.INGEST_TIMEOUT
+        self._con = sqlite3.connect(mbtiles.fullpath, timeout=timeout, isolation_level=None)
+        try:
+            row = self._con.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+            if row is None:
+                raise InvalidFormatError(_("No tiles table in %s") % mbtiles.fullpath)
+            # Deduplicated files expose ``tiles`` as a view over ``map`` and ``images``
+            self.deduplicated = row[0] == 'view'
+            self._con.execute('PRAGMA journal_mode=WAL')
+            self._con.execute('''CREATE TABLE IF NOT EXISTS %s (
+                                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    zoom_level INTEGER,
+                                    tile_column INTEGER,
+                                    tile_row INTEGER,
+                                    updated REAL);''' % self.CHANGES_TABLE)
+            if self.deduplicated:
+                # Images are looked up by id, when written and when orphaned
+                self._con.execute('CREATE INDEX IF NOT EXISTS images_tile_id ON images (tile_id);')
+                self._con.execute('CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id);')
+        except:
+            self._con.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.rollback()
+
+    def write(self, z, x, y, data):
+        """
+        Write the tile (XYZ scheme), replacing any existing one.
+        Raise ``ValueError`` if coordinates are out of range.
+        """
+        z, x, y = check_tile(z, x, y)
+        if self._pending == 0:
+            self._con.execute('BEGIN IMMEDIATE')
+        tms_y = flip_y(y, z)
+        data = sqlite3.Binary(data)
+        if self.deduplicated:
+            tile_id = hashlib.md5(data).hexdigest()
+            previous = self._con.execute('''SELECT tile_id FROM map
+                                            WHERE zoom_level=? AND tile_column=? AND tile_row=?;''',
+                                         (z, x, tms_y)).fetchone()
+            self._con.execute('''INSERT INTO images (tile_data, tile_id)
+                                 SELECT ?, ? WHERE NOT EXISTS
+                                 (SELECT 1 FROM images WHERE tile_id=?);''', (data, tile_id, tile_id))
+            self._con.execute('''INSERT OR REPLACE INTO map
+                                 (zoom_level, tile_column, tile_row, tile_id, grid_id)
+                                 VALUES (?, ?, ?, ?, (SELECT grid_id FROM map
+                                   WHERE zoom_level=? AND tile_column=? AND tile_row=?));''',
+                              (z, x, tms_y, tile_id, z, x, tms_y))
+            if previous is not None and previous[0] != tile_id:
+                # Remove the replaced image unless shared with other tiles
+                self._con.execute('''DELETE FROM images WHERE tile_id=? AND NOT EXISTS
+                                     (SELECT 1 FROM map WHERE tile_id=?);''', (previous[0], previous[0]))
+        else:
+            self._con.execute('''INSERT OR REPLACE INTO tiles
+                                 (zoom_level, tile_column, tile_row, tile_data)
+                                 VALUES (?, ?, ?, ?);''', (z, x, tms_y, data))
+        self._con.execute('''INSERT INTO %s (zoom_level, tile_column, tile_row, updated)
+                             VALUES (?, ?, ?, ?);''' % self.CHANGES_TABLE, (z, x, tms_y, time.time()))
+        self._extend(z, x, y)
+        self._pending += 1
+        self.written += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def ingest(self, tiles):
+        """ Write all (z, x, y, data) of the ``tiles`` iterable. """
+        for (z, x, y, data) in tiles:
+            self.write(z, x, y, data)
+        self.commit()
+        return self.written
+
+    def commit(self):
+        if self._pending > 0:
+            self._con.execute('COMMIT')
+            self._pending = 0
+            self._zoomlevels |= self._batch_zoomlevels
+            self._bounds = _union(self._bounds, self._batch_bounds)
+            self._batch_zoomlevels = set()
+            self._batch_bounds = None
+
+    def rollback(self):
+        """ Cancel the current batch, keeping metadata of committed ones """
+        try:
+            if self._pending > 0:
+                self._con.execute('ROLLBACK')
+                self._pending = 0
+                self._batch_zoomlevels = set()
+                self._batch_bounds = None
+            self._update_metadata()
+        finally:
+            self._con.close()
+
+    def close(self):
+        try:
+            self.commit()
+            self._update_metadata()
+        finally:
+            self._con.close()
+
+    def _extend(self, z, x, y):
+        self._batch_zoomlevels.add(z)
+        self._batch_bounds = _union(self._batch_bounds, tile_bounds(z, x, y))
+
+    def _update_metadata(self):
+        if not self._zoomlevels:
+            return
+        metadata = dict(self._con.execute('SELECT name, value FROM metadata').fetchall())
+        updated = {}
+        # Missing values are not written, since readers fallback on tiles contents
+        if 'minzoom' in metadata:
+            updated['minzoom'] = min(int(metadata['minzoom']), min(self._zoomlevels))
+        if 'maxzoom' in metadata:
+            updated['maxzoom'] = max(int(metadata['maxzoom']), max(self._zoomlevels))
+        bounds = metadata.get('bounds', '').split(',')
+        if len(bounds) == 4:
+            bounds = _union(map(float, bounds), self._bounds)
+            updated['bounds'] = ','.join([repr(v) for v in bounds])
+        self._con.execute('BEGIN IMMEDIATE')
+        for name, value in updated.items():
+            self._con.execute('DELETE FROM metadata WHERE name=?;', (name,))
+            self._con.execute('INSERT INTO metadata (name, value) VALUES (?, ?);', (name, str(value)))
+        self._con.execute('COMMIT')
+
+
+def _union(a, b):
+    """ Union of two (west, south, east, north) bboxes, any of them possibly None """
+    if a is None or b is None:
+        return a or b
+    return (min(a[0], b[0]), min(a[1], b[1]),
+            max(a[2], b[2]), max(a[3], b[3]))
@@ -0,0 +1,154 @@
+import time
+import math
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from . import app_settings
+
+
+class TokenBuckets(object):
+    """
+    In-memory token buckets (one per key), sharded to limit locks contention
+    among threads. Each shard keeps at most MAX_BUCKETS buckets, in least
+    recently used order : buckets full again are dropped, and the least
+    recently used ones are evicted when a shard is full.
+    """
+    SHARDS = 16
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._shards = [(OrderedDict(), threading.Lock()) for i in range(self.SHARDS)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % self.SHARDS]
+
+    def consume(self, key, rate, burst, now=None):
+        """
+        Take a token from the bucket ``key``, refilled at ``rate`` tokens per
+        second up to ``burst``. Return 0 if allowed, otherwise the number of
+        seconds to wait for the next token.
+        """
+        now = time.time() if now is None else now
+        buckets, lock = self._shard(key)
+        with lock:
+            tokens, last = buckets.pop(key, (burst, now, rate, burst))[:2]
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            # Most recently used last
+            buckets[key] = (tokens, now, rate, burst)
+            self._prune(buckets, now)
+        return wait
+
+    def refund(self, key, rate, burst, now=None):
+        """ Give back a token taken by ``consume()`` """
+        buckets, lock = self._shard(key)
+        with lock:
+            if key in buckets:
+                tokens, last, rate, burst = buckets[key]
+                buckets[key] = (min(burst, tokens + 1), last, rate, burst)
+
+    def _prune(self, buckets, now):
+        while buckets:
+            key, (tokens, last, rate, burst) = next(buckets.iteritems())
+            if len(buckets) <= self.MAX_BUCKETS and tokens + (now - last) * rate < burst:
+                break
+            del buckets[key]
+
+    def clear(self):
+        for buckets, lock in self._shards:
+            with lock:
+                buckets.clear()
+
+
+class CacheTokenBuckets(object):
+    """
+    Buckets shared among processes through Django cache. Approximated with
+    fixed windows of ``burst / rate`` seconds allowing ``burst`` requests,
+    relying on atomic ``incr()`` of the cache backend.
+    """
+    def _window(self, key, rate, burst, now):
+        period = float(burst) / rate
+        window = int(now / period)
+        return 'mbtilesmap:ratelimit:%s:%s' % (key, window), period, window
+
+    def consume(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        key, period, window = self._window(key, rate, burst, now)
+        cache.add(key, 0, int(math.ceil(period)) + 1)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired meanwhile
+            cache.add(key, 1, int(math.ceil(period)) + 1)
+            count = 1
+        if count <= burst:
+            return 0
+        return (window + 1) * period - now
+
+    def refund(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        key, period, window = self._window(key, rate, burst, now)
+        try:
+            cache.decr(key)
+        except ValueError:
+            # Expired meanwhile
+            pass
+
+
+memory_buckets = TokenBuckets()
+
+
+def get_buckets():
+    if app_settings.RATE_LIMIT_BACKEND == 'cache':
+        return CacheTokenBuckets()
+    return memory_buckets
+
+
+def client_key(request):
+    """
+    Identify clients by their API key if it is among RATE_LIMIT_API_KEYS,
+    by their IP otherwise.
+    """
+    apikey = request.META.get('HTTP_X_API_KEY') or request.GET.get('key')
+    if apikey and apikey in app_settings.RATE_LIMIT_API_KEYS:
+        return 'key:%s' % apikey
+    return 'ip:%s' % request.META.get('REMOTE_ADDR')
+
+
+def rate_limited(view):
+    """
+    Return 429 responses for clients or tilesets exceeding their limits,
+    before any MBTiles access.
+    """
+    @wraps(view)
+    def wrapper(request, name, *args, **kwargs):
+        limits = []
+        if app_settings.RATE_LIMIT_CLIENT:
+            limits.append((client_key(request), app_settings.RATE_LIMIT_CLIENT))
+        catalog = kwargs.get('catalog')
+        tileset = '%s/%s' % (catalog, name) if catalog else name
+        tileset_limit = app_settings.RATE_LIMIT_TILESETS.get(tileset, app_settings.RATE_LIMIT_TILESET)
+        if tileset_limit:
+            limits.append(('tileset:%s' % tileset, tileset_limit))
+        if limits:
+            buckets = get_buckets()
+            now = time.time()
+            for i, (key, (rate, burst)) in enumerate(limits):
+                wait = buckets.consume(key, rate, burst, now)
+                if wait > 0:
+                    # Rejected requests do not count for previous limits
+                    for key, (rate, burst) in limits[:i]:
+                        buckets.refund(key, rate, burst, now)
+                    response = HttpResponse(status=429)
+                    response['Retry-After'] = str(int(math.ceil(wait)))
+                    return response
+        return view(request, name, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+
+# Sent by ``MBTilesWatcher`` when a MBTiles file is added, replaced or deleted.
+mbtiles_changed = Signal(providing_args=['event', 'name', 'catalog', 'path'])
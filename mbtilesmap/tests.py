@@ -1,17 +1,38 @@
 import os
 import re
+import sys
+import time
+import threading
+import multiprocessing
 import hashlib
 import shutil
+import zlib
 import json
+import sqlite3
+import tempfile
+from StringIO import StringIO
 
 from django.utils import simplejson
 from django.test import TestCase
+from django.test.client import Client
+from django.utils import unittest
 from django.test.client import RequestFactory
 from django.core.urlresolvers import reverse, NoReverseMatch
+from django.core.management import call_command
+from django.core.cache import cache
+from django.contrib.auth.models import User
 from easydict import EasyDict as edict
 
 from . import app_settings, MBTILES_ID_PATTERN
-from models import (MBTiles, MBTilesManager, 
+from ratelimit import TokenBuckets, CacheTokenBuckets, memory_buckets
+from vectortiles import (filter_layers, filtered_tile, filtered_tile_key, layer_names,
+                         gzip, gunzip, is_gzipped, content_encoding)
+from management.commands.mbtiles_generate import generate, synthetic_tile, tile_index, world_tiles
+from utils import tiles_at, tile_at, tile_ranges, tile_bounds, TileRange
+from signals import mbtiles_changed
+import watcher
+from watcher import MBTilesWatcher
+from models import (MBTiles, MBTilesManager, MissingTileError, InvalidFormatError,
                     MBTilesFolderError, MBTilesNotFoundError)
 
 
@@ -254,6 +275,742 @@ class MBTilesContentTest(TestCase):
         self.failUnlessEqual(utfgrid.data[str(c)]['POP_EST'], 1299371)
 
 
+class MBTilesWriterTest(TestCase):
+
+    def setUp(self):
+        self.extrafiles = []
+
+    def tearDown(self):
+        for extrafile in self.extrafiles:
+            os.remove(extrafile)
+
+    def copy(self, name):
+        extrafile = os.path.join(FIXTURES_PATH, 'ingest-%s.mbtiles' % name)
+        shutil.copyfile(os.path.join(FIXTURES_PATH, '%s.mbtiles' % name), extrafile)
+        self.extrafiles.append(extrafile)
+        return MBTiles(extrafile)
+
+    def test_write_tile(self):
+        mb = self.copy('france-35')
+        self.assertRaises(MissingTileError, mb.tile, 6, 31, 22)
+        with mb.writer() as writer:
+            writer.write(6, 31, 22, 'abc')
+        self.failUnlessEqual('abc', str(MBTiles(mb.fullpath).tile(6, 31, 22)))
+        self.failUnlessEqual([3, 5, 6], MBTiles(mb.fullpath).zoomlevels)
+
+    def test_write_tile_deduplicated(self):
+        mb = self.copy('geography-class')
+        with mb.writer() as writer:
+            self.failUnless(writer.deduplicated)
+            writer.write(3, 4, 2, 'abc')
+            writer.write(3, 4, 3, 'abc')
+        mb = MBTiles(mb.fullpath)
+        self.failUnlessEqual('abc', str(mb.tile(3, 4, 2)))
+        self.failUnlessEqual('abc', str(mb.tile(3, 4, 3)))
+        # Grids are left untouched
+        self.failUnless(mb.grid(3, 4, 2))
+
+    def test_writes_are_batched(self):
+        mb = self.copy('france-35')
+        writer = mb.writer(batch_size=2)
+        writer.write(6, 31, 22, 'a')
+        self.failUnlessEqual([], MBTiles(mb.fullpath).changes())
+        writer.write(6, 31, 23, 'b')
+        self.failUnlessEqual(2, len(MBTiles(mb.fullpath).changes()))
+        writer.close()
+
+    def test_changes_are_logged(self):
+        mb = self.copy('france-35')
+        self.failUnlessEqual([], mb.changes())
+        with mb.writer() as writer:
+            written = writer.ingest([(6, 31, 22, 'a'), (6, 32, 22, 'b')])
+        self.failUnlessEqual(2, written)
+        changes = MBTiles(mb.fullpath).changes()
+        self.failUnlessEqual([(6, 31, 22), (6, 32, 22)], [c[1:] for c in changes])
+        self.failUnlessEqual([(6, 32, 22)], [c[1:] for c in MBTiles(mb.fullpath).changes(changes[0][0])])
+
+    def test_metadata_is_extended(self):
+        mb = self.copy('geography-class')
+        with mb.writer() as writer:
+            writer.write(5, 0, 0, 'abc')
+        mb = MBTiles(mb.fullpath)
+        self.failUnlessEqual(5, mb.maxzoom)
+        self.failUnlessEqual(-180.0, mb.bounds[0])
+        self.failUnlessEqual(29.8828, mb.bounds[2])
+        # Bounds are not rounded
+        self.failUnlessEqual(tile_bounds(5, 0, 0)[3], mb.bounds[3])
+
+    def test_metadata_is_extended_with_committed_batches_on_error(self):
+        mb = self.copy('geography-class')
+        def tiles():
+            yield (5, 0, 0, 'a')
+            yield (5, 0, 1, 'b')
+            raise IOError('Interrupted')
+        writer = mb.writer(batch_size=1)
+        self.assertRaises(IOError, writer.ingest, tiles())
+        writer.rollback()
+        mb = MBTiles(mb.fullpath)
+        self.failUnlessEqual(2, len(mb.changes()))
+        self.failUnlessEqual(5, mb.maxzoom)
+        self.failUnless(mb.bounds[3] > 85)
+
+    def test_pending_batch_is_rolled_back(self):
+        mb = self.copy('france-35')
+        try:
+            with mb.writer(batch_size=2) as writer:
+                writer.write(6, 31, 22, 'a')
+                writer.write(6, 31, 23, 'b')
+                writer.write(6, 31, 24, 'c')
+                raise IOError('Interrupted')
+        except IOError:
+            pass
+        mb = MBTiles(mb.fullpath)
+        self.failUnlessEqual([(6, 31, 22), (6, 31, 23)], [c[1:] for c in mb.changes()])
+        self.assertRaises(MissingTileError, mb.tile, 6, 31, 24)
+
+    def test_changes_errors_are_not_hidden(self):
+        extrafile = os.path.join(FIXTURES_PATH, 'ingest-corrupt.mbtiles')
+        with open(extrafile, 'wb') as f:
+            f.write('corrupt' * 1000)
+        self.extrafiles.append(extrafile)
+        self.assertRaises(sqlite3.DatabaseError, MBTiles(extrafile).changes)
+
+    def test_prune_changes(self):
+        mb = self.copy('france-35')
+        self.failUnlessEqual(0, mb.prune_changes(10))
+        with mb.writer() as writer:
+            writer.ingest([(6, 31, 22, 'a'), (6, 32, 22, 'b'), (6, 33, 22, 'c')])
+        seqs = [c[0] for c in mb.changes()]
+        self.failUnlessEqual(2, mb.prune_changes(seqs[2]))
+        self.failUnlessEqual([seqs[2]], [c[0] for c in mb.changes()])
+        # Sequence numbers are not reused
+        with mb.writer() as writer:
+            writer.write(6, 31, 22, 'd')
+        self.failUnless(mb.changes()[-1][0] > seqs[2])
+
+    def test_invalid_coordinates_are_rejected(self):
+        mb = self.copy('geography-class')
+        with mb.writer() as writer:
+            self.assertRaises(ValueError, writer.write, 6, 99, 22, 'abc')
+            self.assertRaises(ValueError, writer.write, 6, 31, -1, 'abc')
+            self.assertRaises(ValueError, writer.write, -1, 0, 0, 'abc')
+        mb = MBTiles(mb.fullpath)
+        self.failUnlessEqual([], mb.changes())
+        self.failUnlessEqual((-18.6328, 32.25, 29.8828, 60.2398), mb.bounds)
+
+    def test_replaced_images_are_removed(self):
+        mb = self.copy('geography-class')
+        with mb.writer() as writer:
+            writer.write(3, 4, 2, 'abc')
+            writer.write(3, 4, 3, 'abc')
+            writer.write(3, 4, 2, 'def')
+        con = sqlite3.connect(mb.fullpath)
+        count = lambda data: con.execute('SELECT COUNT(*) FROM images WHERE tile_id=?',
+                                         (hashlib.md5(data).hexdigest(),)).fetchone()[0]
+        # Still used by another tile
+        self.failUnlessEqual(1, count('abc'))
+        with mb.writer() as writer:
+            writer.write(3, 4, 3, 'def')
+        self.failUnlessEqual(0, count('abc'))
+        self.failUnlessEqual(1, count('def'))
+        con.close()
+
+    def test_invalid_file_is_left_untouched(self):
+        extrafile = os.path.join(FIXTURES_PATH, 'ingest-invalid.mbtiles')
+        con = sqlite3.connect(extrafile)
+        con.execute('CREATE TABLE metadata (name text, value text);')
+        con.close()
+        self.extrafiles.append(extrafile)
+        self.assertRaises(InvalidFormatError, MBTiles(extrafile).writer)
+        con = sqlite3.connect(extrafile)
+        self.failUnlessEqual('delete', con.execute('PRAGMA journal_mode').fetchone()[0])
+        self.failUnlessEqual([('metadata',)], con.execute('SELECT name FROM sqlite_master').fetchall())
+        con.close()
+
+    def test_ingest_command(self):
+        mb = self.copy('france-35')
+        folder = os.path.join(FIXTURES_PATH, 'ingest-tiles')
+        os.makedirs(os.path.join(folder, '6', '31'))
+        os.makedirs(os.path.join(folder, '6', '99'))
+        try:
+            with open(os.path.join(folder, '6', '31', '22.png'), 'wb') as f:
+                f.write('abc')
+            with open(os.path.join(folder, '6', '99', '22.png'), 'wb') as f:
+                f.write('abc')
+            call_command('mbtiles_ingest', mb.fullpath, folder, prune_changes=0, stdout=open(os.devnull, 'w'))
+        finally:
+            shutil.rmtree(folder)
+        mb = MBTiles(mb.fullpath)
+        self.failUnlessEqual('abc', str(mb.tile(6, 31, 22)))
+        self.failUnlessEqual([(6, 31, 22)], [c[1:] for c in mb.changes()])
+
+    def test_upload_view_is_disabled_by_default(self):
+        response = self.client.post(reverse('upload', kwargs=dict(name='geography-class')))
+        self.assertEqual(response.status_code, 404)
+
+    def test_upload_view_requires_staff(self):
+        app_settings.INGEST_VIEW_ENABLED = True
+        try:
+            response = self.client.post(reverse('upload', kwargs=dict(name='geography-class')))
+            self.assertEqual(response.status_code, 403)
+        finally:
+            app_settings.INGEST_VIEW_ENABLED = False
+
+    def upload(self, name, key='6/31/22'):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        app_settings.INGEST_VIEW_ENABLED = True
+        try:
+            tile = StringIO('abc')
+            tile.name = '22.png'
+            return self.client.post(reverse('upload', kwargs=dict(name=name)), {key: tile})
+        finally:
+            app_settings.INGEST_VIEW_ENABLED = False
+
+    def test_upload_view_invalid_file(self):
+        extrafile = os.path.join(FIXTURES_PATH, 'ingest-invalid.mbtiles')
+        con = sqlite3.connect(extrafile)
+        con.execute('CREATE TABLE metadata (name text, value text);')
+        con.close()
+        self.extrafiles.append(extrafile)
+        self.assertEqual(self.upload('ingest-invalid').status_code, 400)
+
+    def test_upload_view_invalid_keys(self):
+        mb = self.copy('france-35')
+        for key in ('a/b/c', '6/31', '6/99/22', '6/31/-1'):
+            self.client.logout()
+            User.objects.all().delete()
+            self.assertEqual(self.upload(mb.id, key).status_code, 400)
+        self.failUnlessEqual([], MBTiles(mb.fullpath).changes())
+
+    def test_upload_view_busy_file(self):
+        mb = self.copy('france-35')
+        con = sqlite3.connect(mb.fullpath, isolation_level=None)
+        con.execute('BEGIN EXCLUSIVE')
+        app_settings.INGEST_TIMEOUT = 0.1
+        try:
+            self.assertEqual(self.upload(mb.id).status_code, 503)
+        finally:
+            app_settings.INGEST_TIMEOUT = 5
+            con.execute('ROLLBACK')
+            con.close()
+
+    def test_upload_view_writes_tiles(self):
+        mb = self.copy('france-35')
+        response = self.upload(mb.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({'written': 1}, json.loads(response.content))
+        self.failUnlessEqual('abc', str(MBTiles(mb.fullpath).tile(6, 31, 22)))
+
+
+class MBTilesWatcherTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'pouet'))
+        self.watcher = MBTilesWatcher(self.root, polling=True)
+        self.received = []
+        mbtiles_changed.connect(self.receive)
+
+    def tearDown(self):
+        mbtiles_changed.disconnect(self.receive)
+        shutil.rmtree(self.root)
+
+    def receive(self, sender, **kwargs):
+        self.received.append((kwargs['event'], kwargs['catalog'], kwargs['name']))
+
+    def deploy(self, name, catalog=''):
+        # Atomic rename, as deployments should do
+        tmpfile = os.path.join(self.root, catalog, '%s.tmp' % name)
+        shutil.copyfile(os.path.join(FIXTURES_PATH, 'france-35.mbtiles'), tmpfile)
+        os.rename(tmpfile, os.path.join(self.root, catalog, '%s.mbtiles' % name))
+
+    def test_nothing_if_unchanged(self):
+        self.deploy('file')
+        self.watcher.poll()
+        self.failUnlessEqual([], self.watcher.poll())
+
+    def test_added_files_are_notified(self):
+        self.deploy('file')
+        self.deploy('country', catalog='pouet')
+        self.watcher.poll()
+        self.failUnlessEqual([('added', None, 'file'), ('added', 'pouet', 'country')], self.received)
+
+    def test_replaced_files_are_notified(self):
+        self.deploy('file')
+        self.watcher.poll()
+        self.deploy('file')
+        self.failUnlessEqual([('replaced', os.path.join(self.root, 'file.mbtiles'))], self.watcher.poll())
+
+    def test_deleted_files_are_notified(self):
+        self.deploy('country', catalog='pouet')
+        self.watcher.poll()
+        shutil.rmtree(os.path.join(self.root, 'pouet'))
+        self.watcher.poll()
+        self.failUnlessEqual(('deleted', 'pouet', 'country'), self.received[-1])
+
+    def test_other_extensions_are_ignored(self):
+        shutil.copyfile(os.path.join(FIXTURES_PATH, 'france-35.mbtiles'), os.path.join(self.root, 'file.tmp'))
+        self.failUnlessEqual([], self.watcher.poll())
+
+    def wait_received(self, count):
+        for i in range(200):
+            if len(self.received) >= count:
+                break
+            time.sleep(0.01)
+
+    @unittest.skipUnless(watcher.pyinotify, "pyinotify is not installed")
+    def test_inotify(self):
+        self.watcher = MBTilesWatcher(self.root, polling=False).start()
+        try:
+            self.failIf(self.watcher.polling)
+            self.deploy('file')
+            self.wait_received(1)
+            self.deploy('country', catalog='pouet')
+            self.wait_received(2)
+            self.deploy('file')
+            self.wait_received(3)
+        finally:
+            self.watcher.stop()
+        self.failUnlessEqual([('added', None, 'file'),
+                              ('added', 'pouet', 'country'),
+                              ('replaced', None, 'file')], self.received)
+
+    def test_polling_thread(self):
+        self.watcher.interval = 0.01
+        self.watcher.start()
+        try:
+            self.deploy('file')
+            for i in range(100):
+                if self.received:
+                    break
+                time.sleep(0.01)
+        finally:
+            self.watcher.stop()
+        self.failUnlessEqual([('added', None, 'file')], self.received)
+
+
+class TileRangesTest(TestCase):
+
+    def test_tile_at(self):
+        self.failUnlessEqual((3, 4, 2), tile_at(2.3401, 48.8503, 3))
+        self.failUnlessEqual((0, 0, 0), tile_at(180, -90, 0))
+        self.failUnlessEqual((2, 3, 3), tile_at(180, -90, 2))
+
+    def test_tiles_at_many_points_and_zooms(self):
+        xs, ys = tiles_at([-1.68, 2.34], [48.11, 48.85], [[5], [10]])
+        self.failUnlessEqual([[15, 16], [507, 518]], xs.tolist())
+        self.failUnlessEqual([[11, 11], [355, 352]], ys.tolist())
+
+    def test_tile_ranges(self):
+        ranges = tile_ranges((-180, -90, 180, 90), [0, 1, 2])
+        self.failUnlessEqual([1, 4, 16], [len(r) for r in ranges])
+        ranges = tile_ranges((-18.6328, 32.25, 29.8828, 60.2398), [2, 3])
+        self.failUnlessEqual(TileRange(2, 1, 1, 2, 1), ranges[0])
+        self.failUnlessEqual(TileRange(3, 3, 2, 4, 3), ranges[1])
+        self.failUnlessEqual([(3, 3, 2), (3, 3, 3), (3, 4, 2), (3, 4, 3)], list(ranges[1]))
+        self.failUnless((3, 4, 2) in ranges[1])
+        self.failIf((3, 5, 2) in ranges[1])
+        self.failIf((2, 4, 2) in ranges[1])
+
+    def test_tile_ranges_edges_are_exclusive(self):
+        ranges = tile_ranges(tile_bounds(1, 0, 0), [1, 2])
+        self.failUnlessEqual([TileRange(1, 0, 0, 0, 0), TileRange(2, 0, 0, 1, 1)], ranges)
+        ranges = tile_ranges(tile_bounds(3, 4, 2), [3])
+        self.failUnlessEqual([TileRange(3, 4, 2, 4, 2)], ranges)
+        # Points on edges
+        self.failUnlessEqual([TileRange(1, 1, 1, 1, 1)], tile_ranges((0, 0, 0, 0), [1]))
+
+    def test_tile_ranges_across_antimeridian(self):
+        ranges = tile_ranges((170, -10, -170, 10), [2])
+        self.failUnlessEqual([TileRange(2, 3, 1, 3, 2), TileRange(2, 0, 1, 0, 2)], ranges)
+        self.failUnlessEqual(4, sum(len(r) for r in tile_ranges((170, -10, -170, 10), [3])))
+
+    def test_empty_tile_range(self):
+        self.assertRaises(ValueError, TileRange, 2, 3, 0, 0, 0)
+
+    def test_tile_ranges_tms(self):
+        ranges = tile_ranges((-18.6328, 32.25, 29.8828, 60.2398), [3], scheme='tms')
+        self.failUnlessEqual(TileRange(3, 3, 4, 4, 5, scheme='tms'), ranges[0])
+
+    def test_mbtiles_tile_ranges(self):
+        mb = MBTiles('geography-class')
+        self.failUnlessEqual([2, 3, 4], [r.z for r in mb.tile_ranges()])
+        self.failUnlessEqual([TileRange(3, 3, 2, 4, 3)], mb.tile_ranges([3]))
+
+
+def vector_layer(name):
+    # version (field 15) and name (field 1) are enough for a valid layer
+    layer = '\x78\x02' + '\x0a' + chr(len(name)) + name
+    return '\x1a' + chr(len(layer)) + layer
+
+
+class VectorTilesTest(TestCase):
+
+    def setUp(self):
+        self.extrafile = os.path.join(FIXTURES_PATH, 'vector.mbtiles')
+        shutil.copyfile(os.path.join(FIXTURES_PATH, 'france-35.mbtiles'), self.extrafile)
+        con = sqlite3.connect(self.extrafile)
+        con.execute("INSERT INTO metadata (name, value) VALUES ('format', 'pbf')")
+        con.execute("INSERT INTO metadata (name, value) VALUES ('json', ?)",
+                    (json.dumps({'vector_layers': [{'id': 'roads'}, {'id': 'water'}]}),))
+        con.commit()
+        con.close()
+        self.data = gzip(vector_layer('roads') + vector_layer('water'))
+        with MBTiles('vector').writer() as writer:
+            writer.write(6, 31, 22, self.data)
+
+    def tearDown(self):
+        os.remove(self.extrafile)
+
+    def test_layer_names(self):
+        self.failUnlessEqual(['roads', 'water'], layer_names(self.data))
+        self.failUnlessEqual(['roads', 'water'], layer_names(gunzip(self.data)))
+
+    def test_filter_layers(self):
+        filtered = filter_layers(self.data, ['water'])
+        self.failUnless(is_gzipped(filtered))
+        self.failUnlessEqual(vector_layer('water'), gunzip(filtered))
+        self.failUnlessEqual('', gunzip(filter_layers(self.data, ['unknown'])))
+
+    def test_filtered_tiles_are_cached(self):
+        key = filtered_tile_key(self.data, ['roads', 'water'])
+        cache.delete(key)
+        filtered = filtered_tile(self.data, ['water', 'roads'])
+        self.failUnlessEqual(['roads', 'water'], layer_names(filtered))
+        self.failUnlessEqual(filtered, cache.get(key))
+        # Served from cache, whatever the layers order
+        cache.set(key, 'cached')
+        self.failUnlessEqual('cached', filtered_tile(self.data, ['roads', 'water']))
+        cache.delete(key)
+
+    def test_zlib_tiles(self):
+        data = zlib.compress(vector_layer('roads') + vector_layer('water'))
+        self.failUnlessEqual('deflate', content_encoding(data))
+        self.failUnlessEqual('gzip', content_encoding(self.data))
+        self.failUnlessEqual(None, content_encoding(vector_layer('roads')))
+        self.failUnlessEqual(['roads', 'water'], layer_names(data))
+        self.failUnlessEqual(vector_layer('water'), gunzip(filter_layers(data, ['water'])))
+
+    def test_should_serve_zlib_vector_tile(self):
+        with MBTiles('vector').writer() as writer:
+            writer.write(6, 31, 23, zlib.compress(vector_layer('roads') + vector_layer('water')))
+        url = reverse('vectortile', kwargs=dict(name='vector', z='6', x='31', y='23'))
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(['roads', 'water'], layer_names(response.content))
+        response = self.client.get(url + '?layers=roads')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(['roads'], layer_names(response.content))
+
+    def test_should_serve_404_if_vector_tile_invalid(self):
+        with MBTiles('vector').writer() as writer:
+            writer.write(6, 31, 23, '\x78\x9c' + 'corrupt')
+        url = reverse('vectortile', kwargs=dict(name='vector', z='6', x='31', y='23'))
+        self.assertEqual(self.client.get(url + '?layers=roads').status_code, 404)
+
+    def test_should_serve_vector_tile(self):
+        response = self.client.get(reverse('vectortile', kwargs=dict(name='vector', z='6', x='31', y='22')))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-type'], 'application/x-protobuf')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(['roads', 'water'], layer_names(response.content))
+
+    def test_should_serve_filtered_vector_tile(self):
+        url = reverse('vectortile', kwargs=dict(name='vector', z='6', x='31', y='22'))
+        response = self.client.get(url + '?layers=water')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(['water'], layer_names(response.content))
+
+    def test_tilejson_lists_vector_layers(self):
+        response = self.client.get(reverse('tilejson', kwargs=dict(name='vector')))
+        tilejson = json.loads(response.content)
+        self.assertEqual([{'id': 'roads'}, {'id': 'water'}], tilejson['vector_layers'])
+        self.assertEqual(tilejson['tiles'][0], 'http://testserver/vector/{z}/{x}/{y}.pbf')
+
+
+class GenerateTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_generate_tiles(self):
+        path = os.path.join(self.root, 'synthetic.mbtiles')
+        self.failUnlessEqual(2, generate(path, 10))
+        mb = MBTiles(path)
+        self.failUnlessEqual([0, 1, 2], mb.zoomlevels)
+        self.failUnlessEqual('png', mb.format)
+        self.failUnlessEqual(synthetic_tile(tile_index(2, 1, 0, 10)), str(mb.tile(2, 1, 0)))
+        self.assertRaises(MissingTileError, mb.tile, 2, 1, 1)
+
+    def test_generate_deduplicated_tiles(self):
+        path = os.path.join(self.root, 'synthetic.mbtiles')
+        generate(path, 100, dedup=0.9, format='pbf', minzoom=3)
+        mb = MBTiles(path)
+        self.failUnlessEqual([3, 4], mb.zoomlevels)
+        con = sqlite3.connect(path)
+        self.failUnlessEqual(10, con.execute('SELECT COUNT(*) FROM images').fetchone()[0])
+        self.failUnlessEqual(100, con.execute('SELECT COUNT(*) FROM tiles').fetchone()[0])
+        con.close()
+        self.failUnlessEqual(['roads', 'water', 'buildings'], layer_names(mb.tile(4, 0, 5)))
+        self.failUnlessEqual(['roads', 'water', 'buildings'], [l['id'] for l in mb.vector_layers])
+
+    def test_generate_command(self):
+        path = os.path.join(self.root, 'synthetic.mbtiles')
+        call_command('mbtiles_generate', path, count=5, format='jpg', stdout=open(os.devnull, 'w'))
+        self.failUnless(str(MBTiles(path).tile(1, 1, 1)).startswith('\xff\xd8'))
+
+
+def stress_env(name, default):
+    return type(default)(os.getenv('MBTILES_STRESS_%s' % name, default))
+
+
+def stress_worker(args):
+    """ Request every url ``count`` times, return the list of unexpected responses """
+    expected, count = args
+    client = Client()
+    errors = []
+    for i in xrange(count):
+        url, status, md5 = expected[i % len(expected)]
+        response = client.get(url)
+        if response.status_code != status or hashlib.md5(response.content).hexdigest() != md5:
+            errors.append(url)
+    return errors
+
+
+@unittest.skipUnless(os.getenv('MBTILES_STRESS_TEST'),
+                     "Set MBTILES_STRESS_TEST to run concurrency stress tests")
+class ConcurrencyStressTest(TestCase):
+    """
+    Hammer views from many threads and processes. Tuned with MBTILES_STRESS_TILES,
+    MBTILES_STRESS_DEDUP, MBTILES_STRESS_THREADS, MBTILES_STRESS_PROCESSES
+    and MBTILES_STRESS_REQUESTS environment variables. Throughputs are
+    written on stderr.
+    """
+    catalog = os.path.join(FIXTURES_PATH, 'stress')
+
+    @classmethod
+    def setUpClass(cls):
+        os.mkdir(cls.catalog)
+        cls.count = stress_env('TILES', 100000)
+        dedup = stress_env('DEDUP', 0.5)
+        distinct = max(1, int(round(cls.count * (1.0 - dedup))))
+        generate(os.path.join(cls.catalog, 'synthetic.mbtiles'), cls.count, dedup)
+        cls.tiles = []
+        for i, (z, x, y) in enumerate(world_tiles(0, cls.count)):
+            if i % max(1, cls.count / 1000) == 0:
+                url = reverse('tile', kwargs=dict(catalog='stress', name='synthetic', z=z, x=x, y=y))
+                data = synthetic_tile(tile_index(z, x, y, distinct))
+                cls.tiles.append((url, 200, hashlib.md5(data).hexdigest()))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.catalog)
+
+    def expected(self, urls):
+        responses = [(url, self.client.get(url)) for url in urls]
+        return [(url, r.status_code, hashlib.md5(r.content).hexdigest()) for url, r in responses]
+
+    def hammer(self, label, expected, threads=True):
+        workers = stress_env('THREADS' if threads else 'PROCESSES', 16 if threads else 4)
+        count = stress_env('REQUESTS', 500)
+        args = [(expected, count)] * workers
+        start = time.time()
+        if threads:
+            results = [None] * workers
+            def run(i):
+                results[i] = stress_worker(args[i])
+            pool = [threading.Thread(target=run, args=(i,)) for i in range(workers)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+        else:
+            pool = multiprocessing.Pool(workers)
+            results = pool.map(stress_worker, args)
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+        total = workers * count
+        sys.stderr.write('\n%s: %s requests with %s %s in %.2fs (%.1f req/s)' % (
+                         label, total, workers, 'threads' if threads else 'processes',
+                         elapsed, total / elapsed))
+        self.failUnlessEqual([], [url for errors in results for url in errors])
+
+    def test_tiles_threads(self):
+        self.hammer('tile', self.tiles)
+
+    def test_tiles_processes(self):
+        self.hammer('tile', self.tiles, threads=False)
+
+    def test_grids_threads(self):
+        urls = [reverse('grid', kwargs=dict(name='geography-class', z=z, x=x, y=y))
+                for (z, x, y) in world_tiles(2, 16)]
+        self.hammer('grid', self.expected(urls))
+
+    def test_tilejson_threads(self):
+        urls = [reverse('tilejson', kwargs=dict(name='geography-class')),
+                reverse('tilejson', kwargs=dict(catalog='stress', name='synthetic'))]
+        self.hammer('tilejson', self.expected(urls))
+
+    def test_tilejson_processes(self):
+        urls = [reverse('tilejson', kwargs=dict(name='geography-class')),
+                reverse('tilejson', kwargs=dict(catalog='stress', name='synthetic'))]
+        self.hammer('tilejson', self.expected(urls), threads=False)
+
+    def test_catalogs_filter_threads(self):
+        # Listing a catalog must not affect concurrent requests on root folder
+        stopped = threading.Event()
+        listings = []
+        def listing():
+            while not stopped.is_set():
+                listings.append([mb.id for mb in MBTiles.objects.filter(catalog='stress')])
+        thread = threading.Thread(target=listing)
+        thread.start()
+        try:
+            urls = [reverse('tile', kwargs=dict(name='geography-class', z=3, x=4, y=2))]
+            self.hammer('tile (with catalog listing)', self.expected(urls))
+        finally:
+            stopped.set()
+            thread.join()
+        self.failUnless(listings)
+        self.failUnlessEqual([], [ids for ids in listings if ids != ['synthetic']])
+
+
+class RateLimitTest(TestCase):
+
+    def tearDown(self):
+        app_settings.RATE_LIMIT_CLIENT = None
+        app_settings.RATE_LIMIT_API_KEYS = ()
+        app_settings.RATE_LIMIT_TILESET = None
+        app_settings.RATE_LIMIT_TILESETS = {}
+        app_settings.RATE_LIMIT_BACKEND = 'memory'
+        memory_buckets.clear()
+
+    def test_token_buckets(self):
+        buckets = TokenBuckets()
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=0))
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=0))
+        self.failUnlessEqual(1, buckets.consume('a', 1, 2, now=0))
+        self.failUnlessEqual(0, buckets.consume('b', 1, 2, now=0))
+        self.failUnlessEqual(0.5, buckets.consume('a', 1, 2, now=0.5))
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=1))
+        buckets.refund('a', 1, 2, now=1)
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=1))
+        self.failUnlessEqual(1, buckets.consume('a', 1, 2, now=1))
+
+    def test_token_buckets_are_bounded(self):
+        buckets = TokenBuckets()
+        buckets.SHARDS, buckets.MAX_BUCKETS = 1, 3
+        buckets.__init__()
+        for key in 'abcde':
+            buckets.consume(key, 0.001, 10, now=0)
+        shard = buckets._shards[0][0]
+        # Least recently used are evicted
+        self.failUnlessEqual(['c', 'd', 'e'], list(shard))
+        buckets.consume('c', 0.001, 10, now=1)
+        self.failUnlessEqual(['d', 'e', 'c'], list(shard))
+        buckets.consume('f', 1, 10, now=2)
+        self.failUnlessEqual(['e', 'c', 'f'], list(shard))
+        # Buckets full again are dropped
+        buckets.consume('g', 1, 10, now=10000)
+        self.failUnlessEqual(['g'], list(shard))
+
+    def test_cache_token_buckets(self):
+        buckets = CacheTokenBuckets()
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=100))
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=100.5))
+        self.failUnlessEqual(1.5, buckets.consume('a', 1, 2, now=100.5))
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=102))
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=102))
+        buckets.refund('a', 1, 2, now=102)
+        self.failUnlessEqual(0, buckets.consume('a', 1, 2, now=102))
+        self.failUnlessEqual(1.0, buckets.consume('a', 1, 2, now=103))
+
+    def tile_url(self, name='geography-class'):
+        return reverse('tile', kwargs=dict(name=name, z='3', x='4', y='2'))
+
+    def test_no_limit_by_default(self):
+        for i in range(5):
+            self.assertEqual(self.client.get(self.tile_url()).status_code, 200)
+
+    def test_client_limit(self):
+        app_settings.RATE_LIMIT_CLIENT = (0.1, 2)
+        self.assertEqual(self.client.get(self.tile_url()).status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url('france-35')).status_code, 200)
+        response = self.client.get(self.tile_url())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '10')
+        # Other clients are not affected
+        self.assertEqual(self.client.get(self.tile_url(), REMOTE_ADDR='10.0.0.1').status_code, 200)
+        app_settings.RATE_LIMIT_API_KEYS = ('abc',)
+        self.assertEqual(self.client.get(self.tile_url(), HTTP_X_API_KEY='abc').status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url() + '?key=abc').status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url() + '?key=abc').status_code, 429)
+
+    def test_unknown_api_keys_are_ignored(self):
+        app_settings.RATE_LIMIT_CLIENT = (0.1, 1)
+        self.assertEqual(self.client.get(self.tile_url()).status_code, 200)
+        for key in ('a', 'b', 'c'):
+            self.assertEqual(self.client.get(self.tile_url(), HTTP_X_API_KEY=key).status_code, 429)
+
+    def test_rejected_requests_do_not_count_for_clients(self):
+        app_settings.RATE_LIMIT_CLIENT = (0.1, 2)
+        app_settings.RATE_LIMIT_TILESETS = {'geography-class': (0.1, 1)}
+        self.assertEqual(self.client.get(self.tile_url()).status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url()).status_code, 429)
+        # Client still has a token left
+        self.assertEqual(self.client.get(self.tile_url('france-35')).status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url('france-35')).status_code, 429)
+
+    def test_tileset_limit(self):
+        app_settings.RATE_LIMIT_TILESETS = {'geography-class': (0.1, 1)}
+        self.assertEqual(self.client.get(self.tile_url()).status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url(), REMOTE_ADDR='10.0.0.1').status_code, 429)
+        grid_url = reverse('grid', kwargs=dict(name='geography-class', z='3', x='4', y='2'))
+        self.assertEqual(self.client.get(grid_url).status_code, 429)
+        self.assertEqual(self.client.get(self.tile_url('france-35')).status_code, 200)
+
+    def test_preview_is_limited_once(self):
+        app_settings.RATE_LIMIT_CLIENT = (0.1, 2)
+        preview_url = reverse('preview', kwargs=dict(name='geography-class'))
+        self.assertEqual(self.client.get(preview_url).status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url()).status_code, 200)
+        self.assertEqual(self.client.get(preview_url).status_code, 429)
+
+    def test_preview_is_limited_per_catalog_tileset(self):
+        os.mkdir(os.path.join(FIXTURES_PATH, 'pouet'))
+        try:
+            shutil.copy(os.path.join(FIXTURES_PATH, 'france-35.mbtiles'),
+                        os.path.join(FIXTURES_PATH, 'pouet', 'geography-class.mbtiles'))
+            app_settings.RATE_LIMIT_TILESETS = {'pouet/geography-class': (0.1, 1)}
+            preview_url = reverse('preview', kwargs=dict(catalog='pouet', name='geography-class'))
+            self.assertEqual(self.client.get(preview_url).status_code, 200)
+            self.assertEqual(self.client.get(preview_url).status_code, 429)
+            # Root tileset of same name is not affected
+            preview_url = reverse('preview', kwargs=dict(name='geography-class'))
+            self.assertEqual(self.client.get(preview_url).status_code, 200)
+            self.assertEqual(self.client.get(preview_url).status_code, 200)
+        finally:
+            shutil.rmtree(os.path.join(FIXTURES_PATH, 'pouet'))
+
+    def test_limit_before_mbtiles_access(self):
+        app_settings.RATE_LIMIT_TILESET = (0.1, 1)
+        self.assertEqual(self.client.get(self.tile_url('unknown')).status_code, 404)
+        self.assertEqual(self.client.get(self.tile_url('unknown')).status_code, 429)
+
+    def test_cache_backend(self):
+        app_settings.RATE_LIMIT_BACKEND = 'cache'
+        app_settings.RATE_LIMIT_CLIENT = (0.01, 2)
+        self.assertEqual(self.client.get(self.tile_url(), REMOTE_ADDR='10.0.0.2').status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url(), REMOTE_ADDR='10.0.0.2').status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url(), REMOTE_ADDR='10.0.0.2').status_code, 429)
+
+
 class MBTilesContentViewsTest(TestCase):
 
     def test_should_serve_image_if_exists(self):
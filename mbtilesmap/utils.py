@@ -1,3 +1,13 @@
+from math import pi, atan, sinh, degrees
+
+import numpy
+
+
+MAX_LATITUDE = 85.0511287798
+# In tiles units
+EDGE_TOLERANCE = 1e-6
+
+
 # This one come from pyramid
 # https://github.com/Pylons/pyramid/blob/master/pyramid/decorator.py
 class reify(object):
@@ -19,3 +29,137 @@ class reify(object):
         val = self.wrapped(inst)
         setattr(inst, self.wrapped.__name__, val)
         return val
+
+
+def flip_y(y, z):
+    """ Convert tile row between XYZ and TMS schemes (both ways) """
+    return (2 ** int(z) - 1) - int(y)
+
+
+def check_tile(z, x, y):
+    """
+    Return the XYZ tile coordinates as integers, raise ``ValueError`` if
+    they are not valid.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if z < 0 or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise ValueError("Invalid tile %s" % ((z, x, y),))
+    return z, x, y
+
+
+def tile_bounds(z, x, y):
+    """
+    Return the WGS84 bbox (west, south, east, north) of the XYZ tile.
+    """
+    n = 2.0 ** int(z)
+    west = int(x) / n * 360.0 - 180.0
+    east = (int(x) + 1) / n * 360.0 - 180.0
+    north = degrees(atan(sinh(pi * (1 - 2 * int(y) / n))))
+    south = degrees(atan(sinh(pi * (1 - 2 * (int(y) + 1) / n))))
+    return (west, south, east, north)
+
+
+def tiles_at(lons, lats, zooms):
+    """
+    Return the (columns, rows) arrays of XYZ tiles containing the points
+    (``lons``, ``lats``) at ``zooms``. Arguments are scalars or arrays,
+    broadcasted together (e.g. ``zooms[:, None]`` for every point at every zoom).
+    """
+    xs, ys, n = _tile_coords(lons, lats, zooms)
+    xs = numpy.clip(numpy.floor(xs), 0, n - 1).astype(numpy.int64)
+    ys = numpy.clip(numpy.floor(ys), 0, n - 1).astype(numpy.int64)
+    return xs, ys
+
+
+def _tile_coords(lons, lats, zooms):
+    """ Return the fractional (columns, rows) of points, and the number of tiles per axis """
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    lats = numpy.clip(numpy.asarray(lats, dtype=numpy.float64), -MAX_LATITUDE, MAX_LATITUDE)
+    n = numpy.power(2.0, numpy.asarray(zooms, dtype=numpy.int64))
+    lats = numpy.radians(lats)
+    xs = (lons + 180.0) / 360.0 * n
+    ys = (1.0 - numpy.arcsinh(numpy.tan(lats)) / pi) / 2.0 * n
+    return xs, ys, n
+
+
+def tile_at(lon, lat, zoom):
+    """ Return the (z, x, y) XYZ tile containing the point at this zoom level. """
+    x, y = tiles_at(lon, lat, zoom)
+    return (int(zoom), int(x), int(y))
+
+
+class TileRange(object):
+    """
+    Compact range of tiles at zoom ``z``, with columns from ``xmin`` to ``xmax``
+    and rows from ``ymin`` to ``ymax`` (inclusive).
+    """
+    __slots__ = ('z', 'xmin', 'ymin', 'xmax', 'ymax', 'scheme')
+
+    def __init__(self, z, xmin, ymin, xmax, ymax, scheme='xyz'):
+        if xmin > xmax or ymin > ymax:
+            raise ValueError("Empty tile range (%s, %s, %s, %s)" % (xmin, ymin, xmax, ymax))
+        self.z = int(z)
+        self.xmin, self.ymin = int(xmin), int(ymin)
+        self.xmax, self.ymax = int(xmax), int(ymax)
+        self.scheme = scheme
+
+    def __len__(self):
+        return (self.xmax - self.xmin + 1) * (self.ymax - self.ymin + 1)
+
+    def __iter__(self):
+        for x in xrange(self.xmin, self.xmax + 1):
+            for y in xrange(self.ymin, self.ymax + 1):
+                yield (self.z, x, y)
+
+    def __contains__(self, tile):
+        z, x, y = tile
+        return (int(z) == self.z and
+                self.xmin <= int(x) <= self.xmax and
+                self.ymin <= int(y) <= self.ymax)
+
+    def __eq__(self, other):
+        return (isinstance(other, TileRange) and
+                self.scheme == other.scheme and
+                self.bounds == other.bounds)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<TileRange %s z=%s x=%s..%s y=%s..%s>' % (self.scheme, self.z, self.xmin,
+                                                          self.xmax, self.ymin, self.ymax)
+
+    @property
+    def bounds(self):
+        return (self.z, self.xmin, self.ymin, self.xmax, self.ymax)
+
+
+def tile_ranges(bbox, zooms, scheme='xyz'):
+    """
+    Return the list of ``TileRange`` covering the WGS84 ``bbox``
+    (west, south, east, north), one per zoom level of ``zooms``, or two
+    if the bbox crosses the antimeridian (``west`` > ``east``).
+    Tiles only touching the edges of the bbox are excluded.
+    Rows are flipped if ``scheme`` is ``tms``.
+    """
+    west, south, east, north = bbox
+    if west > east:
+        western = tile_ranges((west, south, 180.0, north), zooms, scheme)
+        eastern = tile_ranges((-180.0, south, east, north), zooms, scheme)
+        return [r for pair in zip(western, eastern) for r in pair]
+    zooms = numpy.asarray(zooms, dtype=numpy.int64)
+    # Top-left and bottom-right corners at every zoom at once
+    xs, ys, n = _tile_coords([west, east], [north, south], zooms[:, None])
+    # Tiles only touching the edges are excluded (tolerating rounding errors)
+    mins = numpy.floor(numpy.stack([xs[:, 0], ys[:, 0]]) + EDGE_TOLERANCE)
+    maxs = numpy.ceil(numpy.stack([xs[:, 1], ys[:, 1]]) - EDGE_TOLERANCE) - 1
+    maxs = numpy.maximum(mins, maxs)
+    n = n[:, 0]
+    mins = numpy.clip(mins, 0, n - 1).astype(numpy.int64)
+    maxs = numpy.clip(maxs, 0, n - 1).astype(numpy.int64)
+    xs = numpy.stack([mins[0], maxs[0]], axis=1)
+    ys = numpy.stack([mins[1], maxs[1]], axis=1)
+    if scheme == 'tms':
+        ys = (numpy.power(2, zooms)[:, None] - 1) - ys[:, ::-1]
+    return [TileRange(z, x[0], y[0], x[1], y[1], scheme)
+            for z, x, y in zip(zooms.tolist(), xs.tolist(), ys.tolist())]
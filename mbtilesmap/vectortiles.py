@@ -0,0 +1,155 @@
+"""
+Minimal reading of Mapbox Vector Tiles protobuf messages, enough to drop
+layers without decoding features.
+See https://github.com/mapbox/vector-tile-spec
+"""
+import zlib
+import hashlib
+
+from django.core.cache import cache
+
+from . import app_settings
+
+
+GZIP_MAGIC = '\x1f\x8b'
+
+TILE_LAYERS_FIELD = 3
+LAYER_NAME_FIELD = 1
+
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_32BIT = 5
+
+
+class InvalidVectorTileError(Exception):
+    pass
+
+
+def is_gzipped(data):
+    return data[:2] == GZIP_MAGIC
+
+
+def is_zlib(data):
+    """ Zlib header: deflate method (8) and check bits """
+    header = bytearray(data[:2])
+    return (len(header) == 2 and header[0] & 0x0f == 8 and
+            (header[0] * 256 + header[1]) % 31 == 0)
+
+
+def content_encoding(data):
+    """ Return the HTTP Content-Encoding of the stored tile, if compressed """
+    if is_gzipped(data):
+        return 'gzip'
+    if is_zlib(data):
+        return 'deflate'
+    return None
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def decompress(data):
+    """ Return the raw vector tile, whether stored gzipped, zlib-deflated or not """
+    try:
+        if is_gzipped(data):
+            return gunzip(data)
+        if is_zlib(data):
+            return zlib.decompress(data)
+    except zlib.error, e:
+        raise InvalidVectorTileError(e)
+    return data
+
+
+def gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise InvalidVectorTileError("Truncated varint")
+        b = buf[pos]
+        result |= (b & 0x7f) << shift
+        pos += 1
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """
+    Yield (field number, wire type, start, value start, end) of each field
+    of the protobuf message.
+    """
+    pos = 0
+    while pos < len(buf):
+        start = pos
+        key, pos = _varint(buf, pos)
+        field, wiretype = key >> 3, key & 0x7
+        if wiretype == WIRE_VARINT:
+            value, end = _varint(buf, pos)
+        elif wiretype == WIRE_64BIT:
+            end = pos + 8
+        elif wiretype == WIRE_LENGTH_DELIMITED:
+            length, pos = _varint(buf, pos)
+            end = pos + length
+        elif wiretype == WIRE_32BIT:
+            end = pos + 4
+        else:
+            raise InvalidVectorTileError("Unsupported wire type %s" % wiretype)
+        if end > len(buf):
+            raise InvalidVectorTileError("Truncated field %s" % field)
+        yield field, wiretype, start, pos, end
+        pos = end
+
+
+def layer_name(buf):
+    for field, wiretype, start, pos, end in _fields(buf):
+        if field == LAYER_NAME_FIELD and wiretype == WIRE_LENGTH_DELIMITED:
+            return bytes(buf[pos:end]).decode('utf-8')
+    return None
+
+
+def layer_names(data):
+    """ Return the names of the layers of the vector tile """
+    buf = bytearray(decompress(data))
+    return [layer_name(buf[pos:end])
+            for field, wiretype, start, pos, end in _fields(buf)
+            if field == TILE_LAYERS_FIELD]
+
+
+def filter_layers(data, layers):
+    """
+    Return the vector tile ``data`` (raw or compressed) with only the specified
+    ``layers``, gzipped.
+    """
+    buf = bytearray(decompress(data))
+    kept = bytearray()
+    for field, wiretype, start, pos, end in _fields(buf):
+        if field == TILE_LAYERS_FIELD and layer_name(buf[pos:end]) not in layers:
+            continue
+        kept += buf[start:end]
+    return gzip(bytes(kept))
+
+
+def filtered_tile_key(data, layers):
+    key = hashlib.md5(data)
+    key.update('\n'.join(sorted(set(layers))).encode('utf-8'))
+    return 'mbtilesmap:pbf:%s' % key.hexdigest()
+
+
+def filtered_tile(data, layers):
+    """
+    Cached version of ``filter_layers()``. Results are indexed on tile contents,
+    thus never stale, and shared among identical tiles.
+    """
+    key = filtered_tile_key(data, layers)
+    filtered = cache.get(key)
+    if filtered is None:
+        filtered = filter_layers(data, layers)
+        cache.set(key, filtered, app_settings.VECTOR_TILES_CACHE_TIMEOUT)
+    return filtered
@@ -1,21 +1,39 @@
+import json
+import sqlite3
 import logging
 
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseBadRequest
+from django.views.decorators.http import require_POST
 from django.utils.translation import ugettext as _
 
 from . import app_settings
-from models import MBTiles, MissingTileError, MBTilesNotFoundError
+from models import MBTiles, MissingTileError, MBTilesNotFoundError, InvalidFormatError
+from ratelimit import rate_limited
+from utils import check_tile
+from vectortiles import filtered_tile, content_encoding, InvalidVectorTileError
 
 
 logger = logging.getLogger(__name__)
 
 
+@rate_limited
 def tile(request, name, z, x, y, catalog=None):
-    """ Serve a single image tile """
+    """ Serve a single image or vector tile """
+    return _tile(request, name, z, x, y, catalog)
+
+
+def _tile(request, name, z, x, y, catalog=None):
     try:
         mbtiles = MBTiles(name, catalog)
         data = mbtiles.tile(z, x, y)
-        response = HttpResponse(mimetype='image/png')
+        response = HttpResponse(mimetype=mbtiles.mimetype)
+        if mbtiles.format == 'pbf':
+            layers = request.GET.get('layers')
+            if layers:
+                data = filtered_tile(data, layers.split(','))
+            encoding = content_encoding(data)
+            if encoding:
+                response['Content-Encoding'] = encoding
         response.write(data)
         return response
     except MBTilesNotFoundError, e:
@@ -23,20 +41,25 @@ def tile(request, name, z, x, y, catalog=None):
     except MissingTileError:
         logger.warning(_("Tile %s not available in %s") % ((z, x, y), name))
         if not app_settings.MISSING_TILE_404:
-            return HttpResponse(mimetype="image/png")
+            return HttpResponse(mimetype=mbtiles.mimetype)
+    except InvalidVectorTileError, e:
+        logger.error(_("Invalid vector tile %s in %s (%s)") % ((z, x, y), name, e))
     raise Http404
 
 
+@rate_limited
 def preview(request, name, catalog=None):
+    """ Serve the center tile, counted as a tile request by rate limits """
     try:
         mbtiles = MBTiles(name, catalog)
         z, x, y = mbtiles.center_tile()
-        return tile(request, name, z, x, y)
+        return _tile(request, name, z, x, y, catalog)
     except MBTilesNotFoundError, e:
         logger.warning(e)
     raise Http404
 
 
+@rate_limited
 def grid(request, name, z, x, y, catalog=None):
     """ Serve a single UTF-Grid tile """
     callback = request.GET.get('callback', None)
@@ -66,3 +89,38 @@ def tilejson(request, name, catalog=None):
     except MBTilesNotFoundError, e:
         logger.warning(e)
     raise Http404
+
+
+@require_POST
+def upload(request, name, catalog=None):
+    """ Write the posted tiles, one file field per ``z/x/y`` tile """
+    if not app_settings.INGEST_VIEW_ENABLED:
+        raise Http404
+    if not request.user.is_authenticated() or not request.user.is_staff:
+        return HttpResponseForbidden()
+    try:
+        tiles = []
+        for key, uploaded in request.FILES.items():
+            z, x, y = check_tile(*key.split('/'))
+            tiles.append((z, x, y, uploaded.read()))
+    except (ValueError, TypeError):
+        logger.warning(_("Invalid tiles keys %s") % request.FILES.keys())
+        return HttpResponseBadRequest()
+    try:
+        mbtiles = MBTiles(name, catalog)
+        with mbtiles.writer() as writer:
+            written = writer.ingest(tiles)
+        return HttpResponse(json.dumps({'written': written}),
+                            content_type='application/json; charset=utf8')
+    except MBTilesNotFoundError, e:
+        logger.warning(e)
+    except InvalidFormatError, e:
+        logger.warning(e)
+        return HttpResponseBadRequest()
+    except sqlite3.OperationalError, e:
+        if 'locked' not in str(e) and 'busy' not in str(e):
+            raise
+        # Another ingestion is running
+        logger.warning(_("'%s' is busy (%s)") % (name, e))
+        return HttpResponse(status=503)
+    raise Http404
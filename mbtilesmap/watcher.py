@@ -0,0 +1,122 @@
+import os
+import glob
+import logging
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from . import app_settings
+from signals import mbtiles_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+ADDED = 'added'
+REPLACED = 'replaced'
+DELETED = 'deleted'
+
+
+class MBTilesWatcher(object):
+    """
+    Watch MBTILES_ROOT and its catalogs subfolders, and send the
+    ``mbtiles_changed`` signal when MBTiles files are added, replaced or deleted.
+
+    Files are compared by inode, size and modification time, thus new
+    versions can be deployed by atomic rename over the previous ones.
+    Uses inotify if ``pyinotify`` is available, polls every WATCHER_INTERVAL
+    seconds otherwise.
+    """
+    def __init__(self, root=None, interval=None, polling=False):
+        self.root = root or app_settings.MBTILES_ROOT
+        self.interval = interval or app_settings.WATCHER_INTERVAL
+        self.polling = polling or pyinotify is None
+        self._snapshot = self._scan()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._notifier = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        snapshot = {}
+        patterns = [os.path.join(self.root, '*.%s' % app_settings.MBTILES_EXT),
+                    os.path.join(self.root, '*', '*.%s' % app_settings.MBTILES_EXT)]
+        for pattern in patterns:
+            for path in glob.glob(pattern):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed meanwhile
+                    continue
+                snapshot[path] = (stat.st_ino, stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def _publish(self, event, path):
+        catalog = os.path.relpath(os.path.dirname(path), self.root)
+        if catalog == os.curdir:
+            catalog = None
+        name, ext = os.path.splitext(os.path.basename(path))
+        logger.debug("MBTiles %s %s" % (path, event))
+        mbtiles_changed.send(sender=self.__class__, event=event,
+                             name=name, catalog=catalog, path=path)
+
+    def poll(self):
+        """
+        Compare the folder contents with the previous scan, send signals
+        and return the list of (event, path).
+        """
+        with self._lock:
+            previous, current = self._snapshot, self._scan()
+            self._snapshot = current
+        events = []
+        for path in sorted(set(previous) | set(current)):
+            if path not in current:
+                events.append((DELETED, path))
+            elif path not in previous:
+                events.append((ADDED, path))
+            elif previous[path] != current[path]:
+                events.append((REPLACED, path))
+        for event, path in events:
+            self._publish(event, path)
+        return events
+
+    def start(self):
+        if self.polling:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            watcher = self
+
+            class Handler(pyinotify.ProcessEvent):
+                def process_default(self, event):
+                    watcher.poll()
+
+            mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+                    pyinotify.IN_DELETE | pyinotify.IN_CREATE)
+            manager = pyinotify.WatchManager()
+            self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+            self._notifier.daemon = True
+            self._notifier.start()
+            manager.add_watch(self.root, mask, rec=True, auto_add=True)
+        return self
+
+    def stop(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception, e:
+                logger.error(e)